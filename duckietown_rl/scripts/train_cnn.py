@@ -2,6 +2,7 @@ import random
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import gym
 import gym_duckietown
 import os
@@ -15,6 +16,13 @@ from env import launch_env
 
 policy_name = "DDPG"
 
+# When launched with torchrun, one training process per GPU
+distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+if distributed:
+    torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    dist.init_process_group("nccl")
+rank = dist.get_rank() if distributed else 0
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 args = get_ddpg_args_train()
@@ -24,9 +32,9 @@ file_name = "{}_{}".format(
     str(args.seed),
 )
 
-if not os.path.exists("./results"):
+if rank == 0 and not os.path.exists("./results"):
     os.makedirs("./results")
-if args.save_models and not os.path.exists("./pytorch_models"):
+if rank == 0 and args.save_models and not os.path.exists("./pytorch_models"):
     os.makedirs("./pytorch_models")
 
 env = launch_env()
@@ -39,8 +47,8 @@ env = ActionWrapper(env)
 env = DtRewardWrapper(env)
 
 
-# Set seeds
-seed(args.seed)
+# Set seeds, each process explores and samples its replay buffer differently
+seed(args.seed + rank)
 
 state_dim = env.observation_space.shape
 action_dim = env.action_space.shape[0]
@@ -50,7 +58,8 @@ max_action = float(env.action_space.high[0])
 # Initialize policy
 policy = DDPG(state_dim, action_dim, max_action, net_type="cnn")
 
-replay_buffer = ReplayBuffer(args.replay_buffer_max_size)
+# On GPU the replay buffer is kept on the device, batches are sampled without any host transfer
+replay_buffer = ReplayBuffer(args.replay_buffer_max_size, storage_device=device if device.type == "cuda" else None)
 
 # Evaluate untrained policy
 evaluations= [evaluate_policy(env, policy)]
@@ -68,16 +77,18 @@ while total_timesteps < args.max_timesteps:
         if total_timesteps != 0:
             print(("Total T: %d Episode Num: %d Episode T: %d Reward: %f") % (
                 total_timesteps, episode_num, episode_timesteps, episode_reward))
-            policy.train(replay_buffer, episode_timesteps, args.batch_size, args.discount, args.tau)
+            if not distributed:
+                policy.train(replay_buffer, episode_timesteps, args.batch_size, args.discount, args.tau)
 
         # Evaluate episode
         if timesteps_since_eval >= args.eval_freq:
             timesteps_since_eval %= args.eval_freq
             evaluations.append(evaluate_policy(env, policy))
 
-            if args.save_models:
-                policy.save(file_name, directory="./pytorch_models")
-            np.savez("./results/{}.npz".format(file_name),evaluations)
+            if rank == 0:
+                if args.save_models:
+                    policy.save(file_name, directory="./pytorch_models")
+                np.savez("./results/{}.npz".format(file_name),evaluations)
 
         # Reset environment
         env_counter += 1
@@ -117,9 +128,15 @@ while total_timesteps < args.max_timesteps:
     total_timesteps += 1
     timesteps_since_eval += 1
 
+    # The processes end their episodes independently, they train together every env_timesteps steps instead,
+    # on as many batches as steps were collected
+    if distributed and total_timesteps % args.env_timesteps == 0:
+        policy.train(replay_buffer, args.env_timesteps, args.batch_size, args.discount, args.tau)
+
 # Final evaluation
 evaluations.append(evaluate_policy(env, policy))
 
-if args.save_models:
-    policy.save(file_name, directory="./pytorch_models")
-np.savez("./results/{}.npz".format(file_name),evaluations)
+if rank == 0:
+    if args.save_models:
+        policy.save(file_name, directory="./pytorch_models")
+    np.savez("./results/{}.npz".format(file_name),evaluations)
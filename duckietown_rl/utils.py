@@ -15,46 +15,160 @@ def seed(seed):
 # https://github.com/openai/baselines/blob/master/baselines/deepq/replay_buffer.py
 
 # Simple replay buffer
+#
+# Observations are stored once in a circular buffer: the next_state of a transition
+# lives in the slot that holds the state of the following one. Only the first state
+# of an episode needs a slot of its own.
+# Normalized camera frames are kept as uint8 and only converted back to floats by the learner,
+# observations that are not exact multiples of 1/255 in [0, 1] are kept as float32 instead.
+# The storage for all `max_size + 1` slots is reserved up front on the first add(),
+# about 55 MiB per thousand 3x120x160 uint8 frames, four times that in float32.
+# With a `storage_device`, the whole buffer lives on that device and batches are
+# sampled and gathered there; otherwise it is kept in host memory.
 class ReplayBuffer(object):
-    def __init__(self, max_size=1e6):
-        self.storage = []
-        self.max_size = max_size
+    def __init__(self, max_size=10000, storage_device=None):
+        self.max_size = int(max_size)
+        self.storage_device = storage_device
+        # one more slot for the next_state of the latest transition
+        self.num_slots = self.max_size + 1
+        # slot holding the next_state of the latest transition, and a host copy of it
+        self.pos = 0
+        self.last_frame = None
+        # slots starting a transition whose next_state is still stored in the following slot
+        if storage_device is None:
+            self.valid = np.zeros(self.num_slots, dtype=bool)
+        else:
+            self.valid = torch.zeros(self.num_slots, dtype=torch.bool, device=storage_device)
+        self.obs = None
+        # whether observations are stored as uint8 frames, decided on the first add()
+        self.frames = None
+
+    def _allocate(self, state, action):
+        obs_shape = (self.num_slots,) + np.shape(state)
+        action_shape = (self.num_slots,) + np.shape(action)
+        if self.storage_device is None:
+            self.obs = np.empty(obs_shape, dtype=state.dtype)
+            self.actions = np.empty(action_shape, dtype=np.float32)
+            self.rewards = np.empty((self.num_slots, 1), dtype=np.float32)
+            self.dones = np.empty((self.num_slots, 1), dtype=np.float32)
+        else:
+            self.obs = torch.empty(obs_shape, dtype=torch.from_numpy(state).dtype, device=self.storage_device)
+            self.actions = torch.empty(action_shape, dtype=torch.float32, device=self.storage_device)
+            self.rewards = torch.empty((self.num_slots, 1), dtype=torch.float32, device=self.storage_device)
+            self.dones = torch.empty((self.num_slots, 1), dtype=torch.float32, device=self.storage_device)
+
+    def _to_stored(self, obs):
+        if not self.frames:
+            return np.asarray(obs, dtype=np.float32)
+        frame = _to_frame(obs)
+        if frame is None:
+            raise ValueError("The replay buffer stores uint8 frames, the observation is not a multiple of 1/255 in [0, 1]")
+        return frame
 
     # Expects tuples of (state, next_state, action, reward, done)
     def add(self, state, next_state, action, reward, done):
-        if len(self.storage) < self.max_size:
-            self.storage.append((state, next_state, action, reward, done))
-        else:
-            # Remove random element in the memory beforea adding a new one
-            self.storage.pop(random.randrange(len(self.storage)))
-            self.storage.append((state, next_state, action, reward, done))
-
-
-    def sample(self, batch_size=100, flat=True):
-        ind = np.random.randint(0, len(self.storage), size=batch_size)
-        states, next_states, actions, rewards, dones = [], [], [], [], []
-
-        for i in ind:
-            state, next_state, action, reward, done = self.storage[i]
-
-            if flat:
-                states.append(np.array(state, copy=False).flatten())
-                next_states.append(np.array(next_state, copy=False).flatten())
-            else:
-                states.append(np.array(state, copy=False))
-                next_states.append(np.array(next_state, copy=False))
-            actions.append(np.array(action, copy=False))
-            rewards.append(np.array(reward, copy=False))
-            dones.append(np.array(done, copy=False))
-
-        # state_sample, action_sample, next_state_sample, reward_sample, done_sample
-        return {
-            "state": np.stack(states),
-            "next_state": np.stack(next_states),
-            "action": np.stack(actions),
-            "reward": np.stack(rewards).reshape(-1,1),
-            "done": np.stack(dones).reshape(-1,1)
+        if self.frames is None:
+            self.frames = _to_frame(state) is not None and _to_frame(next_state) is not None
+        state, next_state = self._to_stored(state), self._to_stored(next_state)
+
+        if self.obs is None:
+            self._allocate(state, action)
+        elif not np.array_equal(self.last_frame, state):
+            # new episode, keep the last next_state and start from the following slot
+            self.pos = (self.pos + 1) % self.num_slots
+        self.last_frame = next_state.copy()
+
+        if self.storage_device is not None:
+            state, next_state = torch.from_numpy(state), torch.from_numpy(next_state)
+            action = torch.as_tensor(np.asarray(action, dtype=np.float32))
+
+        # overwriting the oldest transitions once the buffer is full
+        self.obs[self.pos] = state
+        self.actions[self.pos] = action
+        self.rewards[self.pos] = reward
+        self.dones[self.pos] = done
+        self.valid[self.pos] = True
+
+        self.pos = (self.pos + 1) % self.num_slots
+        self.obs[self.pos] = next_state
+        self.valid[self.pos] = False
+
+    # Host storage: the sampled fields are gathered into a single page-locked buffer which is sent
+    # to `device` with one asynchronous copy, the returned tensors are views into it.
+    def sample(self, batch_size=100, flat=True, device=None):
+        if self.storage_device is not None:
+            return self._sample_on_storage_device(batch_size, flat, device)
+
+        ind = np.random.choice(np.flatnonzero(self.valid), size=batch_size)
+
+        # states and next states are gathered together from the shared observations,
+        # the float fields go first so that every view stays aligned
+        fields = [
+            ("action", self.actions, ind),
+            ("reward", self.rewards, ind),
+            ("done", self.dones, ind),
+            ("obs", self.obs, np.concatenate([ind, ind + 1])),
+        ]
+        nbytes = [len(index) * array[0].nbytes for _, array, index in fields]
+
+        host_buffer = torch.empty(sum(nbytes), dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        host_array = host_buffer.numpy()
+
+        layout = {}
+        offset = 0
+        for (name, array, index), size in zip(fields, nbytes):
+            out = host_array[offset:offset + size].view(array.dtype).reshape((len(index),) + array.shape[1:])
+            # wraps around the end of the circular buffer, and writes in place with no temporary copy
+            np.take(array, index, axis=0, out=out, mode="wrap")
+            layout[name] = (offset, size, torch.from_numpy(out).dtype, out.shape)
+            offset += size
+
+        buffer = host_buffer if device is None else host_buffer.to(device, non_blocking=True)
+        sample = {
+            name: buffer[offset:offset + size].view(dtype).view(shape)
+            for name, (offset, size, dtype, shape) in layout.items()
+        }
+        return _split_obs(sample, batch_size, flat)
+
+    # Device storage: the indices never leave the device
+    def _sample_on_storage_device(self, batch_size, flat, device):
+        # uniform over the slots starting a transition
+        ind = torch.multinomial(self.valid.float(), batch_size, replacement=True)
+
+        sample = {
+            "action": self.actions.index_select(0, ind),
+            "reward": self.rewards.index_select(0, ind),
+            "done": self.dones.index_select(0, ind),
+            "obs": self.obs.index_select(0, torch.cat([ind, (ind + 1) % self.num_slots])),
         }
+        if device is not None:
+            sample = {name: value.to(device, non_blocking=True) for name, value in sample.items()}
+        return _split_obs(sample, batch_size, flat)
+
+
+# Splits the observations gathered for a sample into its states and next states
+def _split_obs(sample, batch_size, flat):
+    obs = sample.pop("obs")
+    if flat:
+        obs = obs.view(2 * batch_size, -1)
+
+    # state_sample, action_sample, next_state_sample, reward_sample, done_sample
+    sample["state"] = obs[:batch_size]
+    sample["next_state"] = obs[batch_size:]
+    return sample
+
+
+# Observations normalized to [0, 1] (see NormalizeWrapper) are mapped back to [0, 255],
+# None if they aren't multiples of 1/255 in that range
+def _to_frame(obs):
+    obs = np.asarray(obs)
+    if obs.dtype == np.uint8:
+        return obs
+    scaled = obs * 255
+    frame = np.rint(scaled)
+    if frame.min() < 0 or frame.max() > 255 or np.abs(scaled - frame).max() > 1e-3:
+        return None
+    return frame.astype(np.uint8)
 
 
 def evaluate_policy(env, policy, eval_episodes=10, max_timesteps=500):
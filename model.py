@@ -1,18 +1,42 @@
+import contextlib
 import functools
 import operator
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# The input shapes never change, cuDNN benchmarks its algorithms once per shape.
+# TF32 matmuls and convolutions on Ampere and newer GPUs.
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
 # Implementation of Deep Deterministic Policy Gradients (DDPG)
 # Paper: https://arxiv.org/abs/1509.02971
 
 
+# torch.compile and DistributedDataParallel wrap modules, the checkpoints are written with the original parameter names
+def unwrap(module):
+    module = getattr(module, "_orig_mod", module)
+    if isinstance(module, DistributedDataParallel):
+        module = module.module
+    return module
+
+
+# uint8 frames travel to the device as is, the networks see observations in [0, 1]
+def to_float_obs(obs, memory_format=torch.preserve_format):
+    if obs.dtype == torch.uint8:
+        return obs.to(torch.float32, memory_format=memory_format).mul_(1.0 / 255)
+    return obs.to(torch.float32, memory_format=memory_format)
+
+
 class ActorDense(nn.Module):
     def __init__(self, state_dim, action_dim, max_action):
         super(ActorDense, self).__init__()
@@ -34,6 +58,36 @@ class ActorDense(nn.Module):
         return x
 
 
+# Convolutional trunk shared by the CNN actor and critic,
+# kept free of python-side logic so that it can be scripted and fused
+class CNNBackbone(nn.Module):
+    def __init__(self):
+        super(CNNBackbone, self).__init__()
+
+        self.lr = nn.LeakyReLU()
+
+        self.conv1 = nn.Conv2d(3, 32, 8, stride=2)
+        self.conv2 = nn.Conv2d(32, 32, 4, stride=2)
+        self.conv3 = nn.Conv2d(32, 32, 4, stride=2)
+        self.conv4 = nn.Conv2d(32, 32, 4, stride=1)
+
+        # group norm doesn't depend on the batch size nor keeps running statistics,
+        # it behaves the same for replayed batches, single observations and the target networks
+        self.gn1 = nn.GroupNorm(8, 32)
+        self.gn2 = nn.GroupNorm(8, 32)
+        self.gn3 = nn.GroupNorm(8, 32)
+        self.gn4 = nn.GroupNorm(8, 32)
+
+    def forward(self, x):
+        x = self.gn1(self.lr(self.conv1(x)))
+        x = self.gn2(self.lr(self.conv2(x)))
+        x = self.gn3(self.lr(self.conv3(x)))
+        x = self.gn4(self.lr(self.conv4(x)))
+        x = x.reshape(x.size(0), -1)  # flatten, copies when the activations are channels last
+        return x
+
+
+# Acts on the features of the CNNBackbone
 class ActorCNN(nn.Module):
     def __init__(self, action_dim, max_action):
         super(ActorCNN, self).__init__()
@@ -45,30 +99,12 @@ class ActorCNN(nn.Module):
         self.tanh = nn.Tanh()
         self.sigm = nn.Sigmoid()
 
-        self.conv1 = nn.Conv2d(3, 32, 8, stride=2)
-        self.conv2 = nn.Conv2d(32, 32, 4, stride=2)
-        self.conv3 = nn.Conv2d(32, 32, 4, stride=2)
-        self.conv4 = nn.Conv2d(32, 32, 4, stride=1)
-
-        self.bn1 = nn.BatchNorm2d(32)
-        self.bn2 = nn.BatchNorm2d(32)
-        self.bn3 = nn.BatchNorm2d(32)
-        self.bn4 = nn.BatchNorm2d(32)
-
-        self.dropout = nn.Dropout(.5)
-
         self.lin1 = nn.Linear(flat_size, 512)
         self.lin2 = nn.Linear(512, action_dim)
 
         self.max_action = max_action
 
     def forward(self, x):
-        x = self.bn1(self.lr(self.conv1(x)))
-        x = self.bn2(self.lr(self.conv2(x)))
-        x = self.bn3(self.lr(self.conv3(x)))
-        x = self.bn4(self.lr(self.conv4(x)))
-        x = x.view(x.size(0), -1)  # flatten
-        x = self.dropout(x)
         x = self.lr(self.lin1(x))
 
         # this is the vanilla implementation
@@ -76,9 +112,10 @@ class ActorCNN(nn.Module):
         # x = self.max_action * self.tanh(self.lin2(x))
 
         # because we don't want our duckie to go backwards
-        x = self.lin2(x)
-        x[:, 0] = self.max_action * self.sigm(x[:, 0])  # because we don't want the duckie to go backwards
-        x[:, 1] = self.tanh(x[:, 1])
+        velocity, steering = self.lin2(x).unbind(dim=1)
+        velocity = self.max_action * self.sigm(velocity)  # because we don't want the duckie to go backwards
+        steering = self.tanh(steering)
+        x = torch.stack([velocity, steering], dim=1)
 
         return x
 
@@ -90,16 +127,19 @@ class CriticDense(nn.Module):
         state_dim = functools.reduce(operator.mul, state_dim, 1)
 
         self.l1 = nn.Linear(state_dim, 400)
-        self.l2 = nn.Linear(400 + action_dim, 300)
+        # l2 of the concatenated features and actions, split in two blocks to skip the concatenation
+        self.l2_x = nn.Linear(400, 300)
+        self.l2_a = nn.Linear(action_dim, 300, bias=False)
         self.l3 = nn.Linear(300, 1)
 
     def forward(self, x, u):
         x = F.relu(self.l1(x))
-        x = F.relu(self.l2(torch.cat([x, u], 1)))
+        x = F.relu(self.l2_x(x) + self.l2_a(u))
         x = self.l3(x)
         return x
 
 
+# Acts on the features of the CNNBackbone
 class CriticCNN(nn.Module):
     def __init__(self, action_dim):
         super(CriticCNN, self).__init__()
@@ -108,53 +148,72 @@ class CriticCNN(nn.Module):
 
         self.lr = nn.LeakyReLU()
 
-        self.conv1 = nn.Conv2d(3, 32, 8, stride=2)
-        self.conv2 = nn.Conv2d(32, 32, 4, stride=2)
-        self.conv3 = nn.Conv2d(32, 32, 4, stride=2)
-        self.conv4 = nn.Conv2d(32, 32, 4, stride=1)
-
-        self.bn1 = nn.BatchNorm2d(32)
-        self.bn2 = nn.BatchNorm2d(32)
-        self.bn3 = nn.BatchNorm2d(32)
-        self.bn4 = nn.BatchNorm2d(32)
-
-        self.dropout = nn.Dropout(.5)
-
         self.lin1 = nn.Linear(flat_size, 256)
-        self.lin2 = nn.Linear(256 + action_dim, 128)
+        # lin2 of the concatenated features and actions, split in two blocks to skip the concatenation
+        self.lin2_x = nn.Linear(256, 128)
+        self.lin2_a = nn.Linear(action_dim, 128, bias=False)
         self.lin3 = nn.Linear(128, 1)
 
-    def forward(self, states, actions):
-        x = self.bn1(self.lr(self.conv1(states)))
-        x = self.bn2(self.lr(self.conv2(x)))
-        x = self.bn3(self.lr(self.conv3(x)))
-        x = self.bn4(self.lr(self.conv4(x)))
-        x = x.view(x.size(0), -1)  # flatten
+    def forward(self, x, actions):
         x = self.lr(self.lin1(x))
-        x = self.lr(self.lin2(torch.cat([x, actions], 1)))  # c
+        x = self.lr(self.lin2_x(x) + self.lin2_a(actions))
         x = self.lin3(x)
 
         return x
 
 
 class DDPG(object):
-    def __init__(self, state_dim, action_dim, max_action, net_type):
+    def __init__(self, state_dim, action_dim, max_action, net_type, amp=True, compile_model=True):
         super(DDPG, self).__init__()
         assert net_type in ["cnn", "dense"]
 
         self.state_dim = state_dim
 
+        # Multi-GPU training with one process per GPU (e.g. launched with torchrun), each process
+        # collects and samples its own replay buffer and the gradients are averaged across processes.
+        self.distributed = dist.is_available() and dist.is_initialized()
+
+        # Mixed precision training, the losses are scaled to keep the fp16 gradients from underflowing
+        self.amp = amp and device.type == "cuda"
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.amp)
+
+        # Let Inductor specialize the networks for the fixed batch and image shapes and replay them
+        # through CUDA graphs. The conv trunks are then left to Inductor instead of TorchScript.
+        # Distributed training stays eager, DDP's gradient hooks and no_sync() are kept out of the CUDA graphs.
+        self.compile_model = (compile_model and not self.distributed and device.type == "cuda"
+                              and hasattr(torch, "compile"))
+
+        # The actor and the critic share one encoder of the observations, it is trained through the critic loss
         if net_type == "dense":
             self.flat = True
+            self.memory_format = torch.preserve_format
+            self.encoder = nn.Identity()
+            self.encoder_target = nn.Identity()
+        else:
+            self.flat = False
+            # NHWC lets cuDNN pick its tensor core convolutions
+            self.memory_format = torch.channels_last if device.type == "cuda" else torch.preserve_format
+            self.encoder = CNNBackbone().to(device, memory_format=self.memory_format)
+            self.encoder_target = CNNBackbone().to(device, memory_format=self.memory_format)
+            if not self.compile_model:
+                self.encoder = torch.jit.script(self.encoder)
+                self.encoder_target = torch.jit.script(self.encoder_target)
+        self.encoder_target.load_state_dict(self.encoder.state_dict())
+
+        if net_type == "dense":
             self.actor = ActorDense(state_dim, action_dim, max_action).to(device)
             self.actor_target = ActorDense(state_dim, action_dim, max_action).to(device)
         else:
-            self.flat = False
             self.actor = ActorCNN(action_dim, max_action).to(device)
             self.actor_target = ActorCNN(action_dim, max_action).to(device)
 
         self.actor_target.load_state_dict(self.actor.state_dict())
-        self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=1e-4)
+        # With AMP, the fused Adam takes the scale and the inf checks from the GradScaler on the device,
+        # other optimizers make it read the inf checks back on the host, a sync on every step.
+        # None keeps PyTorch's default implementation.
+        fused = self.amp or None
+        self.actor_optimizer = torch.optim.Adam(
+            self.actor.parameters(), lr=1e-4, fused=fused)
 
         if net_type == "dense":
             self.critic = CriticDense(state_dim, action_dim).to(device)
@@ -163,7 +222,53 @@ class DDPG(object):
             self.critic = CriticCNN(action_dim).to(device)
             self.critic_target = CriticCNN(action_dim).to(device)
         self.critic_target.load_state_dict(self.critic.state_dict())
-        self.critic_optimizer = torch.optim.Adam(self.critic.parameters())
+        self.critic_optimizer = torch.optim.Adam(
+            list(self.encoder.parameters()) + list(self.critic.parameters()), fused=fused)
+
+        # The target networks only follow the online networks through the soft update,
+        # they run in eval mode and autograd has nothing to track through them.
+        for target in (self.encoder_target, self.actor_target, self.critic_target):
+            target.eval()
+            for param in target.parameters():
+                param.requires_grad_(False)
+
+        # Parameters of the soft target updates, in matching order, the encoder goes with the critic
+        self._actor_params = list(self.actor.parameters())
+        self._actor_targets = list(self.actor_target.parameters())
+        self._critic_params = list(self.encoder.parameters()) + list(self.critic.parameters())
+        self._critic_targets = list(self.encoder_target.parameters()) + list(self.critic_target.parameters())
+
+        if self.distributed:
+            device_ids = [torch.cuda.current_device()] if device.type == "cuda" else None
+            if not self.flat:
+                self.encoder = DistributedDataParallel(self.encoder, device_ids=device_ids)
+            self.actor = DistributedDataParallel(self.actor, device_ids=device_ids)
+            self.critic = DistributedDataParallel(self.critic, device_ids=device_ids)
+
+            # the replicas start from the parameters of the first process, so do the target networks
+            self.encoder_target.load_state_dict(unwrap(self.encoder).state_dict())
+            self.actor_target.load_state_dict(unwrap(self.actor).state_dict())
+            self.critic_target.load_state_dict(unwrap(self.critic).state_dict())
+
+        if self.compile_model:
+            self.encoder = torch.compile(self.encoder, mode="reduce-overhead", dynamic=False)
+            self.encoder_target = torch.compile(self.encoder_target, mode="reduce-overhead", dynamic=False)
+            self.actor = torch.compile(self.actor, mode="reduce-overhead", dynamic=False)
+            self.actor_target = torch.compile(self.actor_target, mode="reduce-overhead", dynamic=False)
+            self.critic = torch.compile(self.critic, mode="reduce-overhead", dynamic=False)
+            self.critic_target = torch.compile(self.critic_target, mode="reduce-overhead", dynamic=False)
+
+        # Inference path of predict(), on the unwrapped networks: with torch.compile it gets its own graph,
+        # specialized for a single observation, next to the training ones.
+        self.policy = nn.Sequential(unwrap(self.encoder), unwrap(self.actor))
+        if self.compile_model:
+            self.policy = torch.compile(self.policy, mode="reduce-overhead", dynamic=False)
+
+        # Page-locked buffer that receives the predicted actions
+        self._action_out = torch.empty(action_dim, pin_memory=device.type == "cuda")
+
+        # Side stream on which the next replay batch is uploaded while the current one trains
+        self.copy_stream = torch.cuda.Stream() if device.type == "cuda" else None
 
     def close(self):
         # TODO: release resources
@@ -173,64 +278,134 @@ class DDPG(object):
         # just making sure the state has the correct format, otherwise the prediction doesn't work
         assert state.shape[0] == 3
 
+        # one upload of the observation, uint8 frames as is and anything else as float32,
+        # the batch dimension is added on the device
+        if state.dtype != np.uint8:
+            state = state.astype(np.float32, copy=False)
+        state = torch.as_tensor(state, device=device).unsqueeze(0)
+        state = to_float_obs(state, self.memory_format)
         if self.flat:
-            state = torch.FloatTensor(state.reshape(1, -1)).to(device)
-        else:
-            state = torch.FloatTensor(np.expand_dims(state, axis=0)).to(device)
-        return self.actor(state).cpu().data.numpy().flatten()
-
+            state = state.reshape(1, -1)
+
+        if self.compile_model:
+            torch.compiler.cudagraph_mark_step_begin()
+        with torch.inference_mode():
+            action = self.policy(state)
+            self._action_out.copy_(action.squeeze(0), non_blocking=True)
+        # the device only sends back the action, wait for it to land in the buffer
+        if device.type == "cuda":
+            torch.cuda.current_stream().synchronize()
+        # the buffer is reused by the next prediction
+        return self._action_out.numpy().copy()
+
+    def _sample_to_device(self, replay_buffer, batch_size):
+        copy_context = contextlib.nullcontext()
+        if self.copy_stream is not None:
+            # a replay buffer stored on the device is written on the compute stream, sample after those writes
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            copy_context = torch.cuda.stream(self.copy_stream)
+
+        with copy_context:
+            batch = replay_buffer.sample(batch_size, flat=self.flat, device=device)
+
+        if self.copy_stream is not None:
+            # the batch is consumed on the compute stream, keep the allocator from recycling it early
+            for value in batch.values():
+                value.record_stream(torch.cuda.current_stream())
+        return batch
+
+    # When distributed, every process has to train for the same number of iterations
     def train(self, replay_buffer, iterations, batch_size=64, discount=0.99, tau=0.001):
 
+        # Batch it + 1 is uploaded on the copy stream while batch it is trained on
+        next_batch = self._sample_to_device(replay_buffer, batch_size) if iterations > 0 else None
+
         for it in range(iterations):
 
             # Sample replay buffer
-            sample = replay_buffer.sample(batch_size, flat=self.flat)
-            state = torch.FloatTensor(sample["state"]).to(device)
-            action = torch.FloatTensor(sample["action"]).to(device)
-            next_state = torch.FloatTensor(sample["next_state"]).to(device)
-            done = torch.FloatTensor(1 - sample["done"]).to(device)
-            reward = torch.FloatTensor(sample["reward"]).to(device)
-
-            # Compute the target Q value
-            target_Q = self.critic_target(next_state, self.actor_target(next_state))
-            target_Q = reward + (done * discount * target_Q).detach()
-
-            # Get current Q estimate
-            current_Q = self.critic(state, action)
+            if self.copy_stream is not None:
+                torch.cuda.current_stream().wait_stream(self.copy_stream)
+            sample = next_batch
+            if it + 1 < iterations:
+                next_batch = self._sample_to_device(replay_buffer, batch_size)
+
+            if self.compile_model:
+                # lets the CUDA graphs of the compiled networks reuse the previous iteration's outputs
+                torch.compiler.cudagraph_mark_step_begin()
+
+            self._train_step(sample, discount, tau)
+
+    def _train_step(self, sample, discount, tau):
+        state = to_float_obs(sample["state"], self.memory_format)
+        action = sample["action"]
+        next_state = to_float_obs(sample["next_state"], self.memory_format)
+        done = 1 - sample["done"]
+        reward = sample["reward"]
+
+        # Compute the target Q value, no activations are saved for the target networks
+        with torch.no_grad():
+            with torch.autocast(device.type, enabled=self.amp):
+                next_features = self.encoder_target(next_state)
+                target_Q = self.critic_target(next_features, self.actor_target(next_features))
+            # the Bellman target is accumulated in full precision
+            target_Q = reward + done * discount * target_Q.float()
+
+        with torch.autocast(device.type, enabled=self.amp):
+            # Get current Q estimate, the state goes through the encoder once per iteration
+            features = self.encoder(state)
+            current_Q = self.critic(features, action)
 
             # Compute critic loss
             critic_loss = F.mse_loss(current_Q, target_Q)
 
-            # Optimize the critic
-            self.critic_optimizer.zero_grad()
-            critic_loss.backward()
-            self.critic_optimizer.step()
+        # Optimize the critic
+        self.critic_optimizer.zero_grad(set_to_none=True)
+        self.scaler.scale(critic_loss).backward()
+        self.scaler.step(self.critic_optimizer)
+
+        # Compute actor loss, on the features detached from the encoder
+        features = features.detach()
+        with self._no_critic_sync(), torch.autocast(device.type, enabled=self.amp):
+            actor_loss = -self.critic(features, self.actor(features)).mean()
+
+        # Optimize the actor
+        self.actor_optimizer.zero_grad(set_to_none=True)
+        self.scaler.scale(actor_loss).backward()
+        self.scaler.step(self.actor_optimizer)
 
-            # Compute actor loss
-            actor_loss = -self.critic(state, self.actor(state)).mean()
+        # one scale update per iteration, once both optimizers have stepped
+        self.scaler.update()
 
-            # Optimize the actor
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
+        # Update the frozen target models, one multi-tensor kernel per op for all the tensors
+        with torch.no_grad():
+            torch._foreach_mul_(self._critic_targets, 1 - tau)
+            torch._foreach_add_(self._critic_targets, self._critic_params, alpha=tau)
 
-            # Update the frozen target models
-            for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-                target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+            torch._foreach_mul_(self._actor_targets, 1 - tau)
+            torch._foreach_add_(self._actor_targets, self._actor_params, alpha=tau)
 
-            for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-                target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+    def _no_critic_sync(self):
+        # the critic gradients of the actor loss are dropped, don't average them across processes
+        if self.distributed:
+            return self.critic.no_sync()
+        return contextlib.nullcontext()
 
     def save(self, filename, directory):
-        torch.save(self.actor.state_dict(), '{}/{}_actor.pth'.format(directory, filename))
-        torch.save(self.critic.state_dict(), '{}/{}_critic.pth'.format(directory, filename))
+        torch.save(unwrap(self.encoder).state_dict(), '{}/{}_encoder.pth'.format(directory, filename))
+        torch.save(unwrap(self.actor).state_dict(), '{}/{}_actor.pth'.format(directory, filename))
+        torch.save(unwrap(self.critic).state_dict(), '{}/{}_critic.pth'.format(directory, filename))
 
     def load(self, filename, directory, for_inference=False):
-        self.actor.load_state_dict(torch.load('{}/{}_actor.pth'.format(directory, filename), map_location=device))
-        self.critic.load_state_dict(torch.load('{}/{}_critic.pth'.format(directory, filename), map_location=device))
+        unwrap(self.encoder).load_state_dict(
+            torch.load('{}/{}_encoder.pth'.format(directory, filename), map_location=device))
+        unwrap(self.actor).load_state_dict(
+            torch.load('{}/{}_actor.pth'.format(directory, filename), map_location=device))
+        unwrap(self.critic).load_state_dict(
+            torch.load('{}/{}_critic.pth'.format(directory, filename), map_location=device))
         if for_inference:
             # If we're not learning anymore, set model layers to
-            # test mode (this disables dropout and changes batchnorm).
+            # test mode.
             # This does NOT affect autograd.
+            self.encoder.eval()
             self.actor.eval()
             self.critic.eval()